@@ -1,83 +1,350 @@
 import os
+import io
 import subprocess
 import tempfile
 import argparse
-from PIL import Image, ImageSequence
+from PIL import Image, ImageSequence, GifImagePlugin
 import math
+import hashlib
 import shutil
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import time  # 添加时间模块导入
 
+# gifsicle的绝对路径：可执行文件带目录时subprocess才会走posix_spawn，配合close_fds=False减少启动开销
+GIFSICLE = shutil.which('gifsicle') or 'gifsicle'
+# lossy压缩级别，按压缩强度递增排列
+LOSSY_LEVELS = [30, 60, 90, 120, 150, 180, 210, 240]
+# 生成全局调色板时最多采样的帧数，限制拼接图的内存占用
+PALETTE_SAMPLE_FRAMES = 16
+
+# 优先把临时文件放在内存文件系统上
+TEMP_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# 工作进程共享的取消事件和输入GIF路径，由进程池初始化函数设置
+_cancel_event = None
+_input_path = None
+# 回退到Pillow抽帧时才解码的输入GIF帧及原始信息：默认以fork启动工作进程时由主进程解码一次，工作进程直接继承
+_FRAMES = None
+_INFO = None
+
+def load_frames(gif_path):
+    """只打开一次GIF，读取原始延迟和循环次数并解码全部帧，返回帧列表和信息"""
+    frames = []
+    # 没有局部调色板的帧保持P模式解码，每帧只保留单字节索引缓冲；
+    # 不做额外量化，颜色只在量化到全局调色板时损失一次
+    loading_strategy = GifImagePlugin.LOADING_STRATEGY
+    GifImagePlugin.LOADING_STRATEGY = GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
+    try:
+        with Image.open(gif_path) as img:
+            # 在遍历前读取，遍历时info会随当前帧变化
+            info = {
+                'duration': img.info.get('duration', 100),  # 默认100ms
+                'loop': img.info.get('loop', 0)  # 默认无限循环
+            }
+            try:
+                for frame in ImageSequence.Iterator(img):
+                    frames.append(frame.copy())
+            except OSError:
+                # 文件尾部损坏时保留已解码的帧，至少要有一帧
+                if not frames:
+                    raise
+    finally:
+        GifImagePlugin.LOADING_STRATEGY = loading_strategy
+    return frames, info
+
+def init_worker(cancel_event, input_path=None):
+    """进程池初始化函数：保存主进程传入的取消事件和输入GIF路径"""
+    global _cancel_event, _input_path
+    _cancel_event = cancel_event
+    _input_path = input_path
+
+def preload_frames(gif_path):
+    """在主进程中解码输入GIF，随后fork出的工作进程无需再次解码"""
+    global _FRAMES, _INFO
+    _FRAMES, _INFO = load_frames(gif_path)
+
+def release_frames():
+    """Pillow抽帧结束后释放主进程中解码的帧"""
+    global _FRAMES, _INFO
+    _FRAMES = None
+    _INFO = None
+
+def ensure_frames_loaded():
+    """工作进程未从主进程继承已解码的帧时（非fork启动方式），首次需要时自行解码，之后的任务直接复用"""
+    global _FRAMES, _INFO
+    if _FRAMES is None:
+        _FRAMES, _INFO = load_frames(_input_path)
+
+def is_cancelled():
+    """检查主进程是否已找到达标结果并要求其余任务停止"""
+    return _cancel_event is not None and _cancel_event.is_set()
+
 def get_file_size_kb(file_path):
     """获取文件大小（KB）"""
     return os.path.getsize(file_path) / 1024
 
-def get_frame_count(gif_path):
-    """获取GIF的帧数"""
-    with Image.open(gif_path) as img:
-        return sum(1 for _ in ImageSequence.Iterator(img))
-
-def extract_frames(input_gif, output_pattern, skip=1, delay=10):
-    """提取GIF的帧并保存为单独的GIF文件"""
-    with Image.open(input_gif) as img:
-        frames = []
-        for i, frame in enumerate(ImageSequence.Iterator(img)):
-            if i % skip == 0:  # 每隔skip帧取一帧
-                frames.append(frame.copy())
+def create_temp_gif(temp_dir):
+    """在temp_dir中创建临时GIF文件并返回路径，mkstemp返回的文件描述符立即关闭"""
+    fd, path = tempfile.mkstemp(suffix='.gif', dir=temp_dir)
+    os.close(fd)
+    return path
+
+def remove_output(output_path):
+    """删除已存在的输出文件：输出可能是硬链接，原地覆盖写入会同时修改共享inode的其他文件"""
+    if os.path.lexists(output_path):
+        os.unlink(output_path)
+
+def link_or_copy(src, dst):
+    """复制文件：优先创建硬链接，其次用copy_file_range在内核中复制（支持的文件系统上为写时复制），最后回退到普通复制"""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    remove_output(dst)
     
-    # 获取原始GIF的信息
-    with Image.open(input_gif) as img:
-        original_duration = img.info.get('duration', 100)  # 默认100ms
-        loop = img.info.get('loop', 0)  # 默认无限循环
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                shutil.copymode(src, dst)
+                return
+        except OSError:
+            pass
+    
+    shutil.copy(src, dst)
+
+def move_file(src, dst):
+    """移动文件：同一设备上直接重命名，跨设备时回退到shutil.move"""
+    dst_dir = os.path.dirname(os.path.abspath(dst))
+    if os.stat(src).st_dev == os.stat(dst_dir).st_dev:
+        os.replace(src, dst)
+    else:
+        remove_output(dst)
+        shutil.move(src, dst)
+
+def is_closer_to_target(size, best_size, target_size_kb):
+    """判断size是否比best_size更优：优先选择不超过目标且最接近目标的结果，否则选择更小的结果"""
+    if size <= target_size_kb:
+        return best_size > target_size_kb or size > best_size
+    return best_size > target_size_kb and size < best_size
+
+def skip_sub_blocks(data, pos):
+    """跳过从pos开始的GIF数据子块序列，返回终止块之后的位置"""
+    while True:
+        block_size = data[pos]
+        pos += 1 + block_size
+        if block_size == 0:
+            return pos
+
+def scan_frame_keys(data):
+    """遍历GIF的块结构，为每个图像描述符生成一个去重键，无需LZW解码
+    
+    覆盖整个画布且没有透明色的帧，显示结果与之前的帧无关，键为其图像块的哈希，
+    键相同即画面相同；其余帧无法不解码判断，键为None
+    """
+    if data[:6] not in (b'GIF87a', b'GIF89a'):
+        raise ValueError("不是有效的GIF文件")
+    
+    # 逻辑屏幕描述符 + 全局颜色表
+    screen_size = data[6:10]
+    packed = data[10]
+    pos = 13
+    if packed & 0x80:
+        pos += 3 * (2 << (packed & 0x07))
+    
+    keys = []
+    transparent = False
+    while pos < len(data):
+        block_type = data[pos]
+        if block_type == 0x21:  # 扩展块：标签 + 子块
+            if data[pos + 1] == 0xF9:  # 图形控制扩展，标志字节最低位为透明色标志
+                transparent = bool(data[pos + 3] & 0x01)
+            pos = skip_sub_blocks(data, pos + 2)
+        elif block_type == 0x2C:  # 图像描述符
+            start = pos
+            full_canvas = data[pos + 1:pos + 5] == b'\0\0\0\0' and data[pos + 5:pos + 9] == screen_size
+            packed = data[pos + 9]  # 位置和尺寸之后的标志字节
+            pos += 10
+            if packed & 0x80:  # 局部颜色表
+                pos += 3 * (2 << (packed & 0x07))
+            pos = skip_sub_blocks(data, pos + 1)  # 跳过LZW最小码长和图像数据
+            if full_canvas and not transparent:
+                keys.append(hashlib.blake2b(data[start:pos], digest_size=8).digest())
+            else:
+                keys.append(None)
+            transparent = False
+        elif block_type == 0x3B:  # 文件结束
+            break
+        else:
+            raise ValueError(f"未知的GIF块类型: {block_type:#x}")
+    return keys
+
+def get_frame_keys(gif_path):
+    """获取GIF每帧的去重键，列表长度即帧数；解析失败时回退到Pillow逐帧解码计数，此时不做去重"""
+    try:
+        with open(gif_path, 'rb') as f:
+            return scan_frame_keys(f.read())
+    except (ValueError, IndexError):
+        with Image.open(gif_path) as img:
+            return [None] * sum(1 for _ in ImageSequence.Iterator(img))
+
+def has_transparency(frame):
+    """判断帧是否含有透明像素信息（RGBA/PA模式或P模式的透明色索引）"""
+    return frame.mode in ('RGBA', 'PA') or 'transparency' in frame.info
+
+def build_shared_palette(frames, colors=256):
+    """从采样帧拼接出的大图生成所有帧共用的自适应调色板"""
+    step = max(1, math.ceil(len(frames) / PALETTE_SAMPLE_FRAMES))
+    samples = frames[::step]
+    width, height = samples[0].size
+    master = Image.new('RGB', (width, height * len(samples)))
+    for i, frame in enumerate(samples):
+        master.paste(frame.convert('RGB'), (0, i * height))
+    return master.convert('P', palette=Image.ADAPTIVE, colors=colors)
+
+def extract_frames(output, skip=1, delay=10):
+    """从工作进程解码的帧中每隔skip帧取一帧并保存为GIF，output可以是文件路径或文件对象"""
+    ensure_frames_loaded()
+    frames = _FRAMES[::skip]
     
     # 应用新的延迟
     if delay is None:
         # 根据跳帧比例调整延迟
-        delay = original_duration * skip
+        delay = _INFO['duration'] * skip
+    
+    # 所有帧量化到同一调色板，减小交给gifsicle的数据量
+    transparent = any(has_transparency(frame) for frame in frames)
+    # 含透明像素时少生成一色，把调色板末尾之后的一个索引留给透明色
+    master = build_shared_palette(frames, 255 if transparent else 256)
+    palette = master.getpalette()
+    transparent_index = len(palette) // 3
+    if transparent:
+        palette += [0, 0, 0]
+    quantized = []
+    for frame in frames:
+        frame_p = frame.convert('RGB').quantize(palette=master, dither=Image.NONE)
+        # quantize会沿用原帧info中的透明色，转换RGB后它可能是颜色元组，GIF写入时无法使用
+        frame_p.info.pop('transparency', None)
+        if transparent:
+            # 透明像素写入保留的透明色索引，而不是展平为其RGB颜色
+            alpha = frame.convert('RGBA').getchannel('A')
+            frame_p.paste(transparent_index, mask=alpha.point(lambda a: 255 if a == 0 else 0))
+        quantized.append(frame_p)
+    
+    # 帧都是合成后的完整画面，含透明像素时每帧显示前需清除上一帧，否则上一帧会从透明处透出来
+    extra = {'transparency': transparent_index, 'disposal': 2} if transparent else {}
     
     # 保存为新的GIF文件
-    if frames:
-        frames[0].save(
-            output_pattern,
-            save_all=True,
-            append_images=frames[1:],
-            optimize=False,  # 由gifsicle优化
-            duration=delay,
-            loop=loop
-        )
+    quantized[0].save(
+        output,
+        format='GIF',
+        save_all=True,
+        append_images=quantized[1:],
+        optimize=False,  # 由gifsicle优化
+        palette=palette,
+        duration=delay,
+        loop=_INFO['loop'],
+        **extra
+    )
+
+def merge_duplicate_frames(frame_keys, skip):
+    """每隔skip帧选取一帧，与上一个保留帧画面相同的帧并入上一帧，返回 [帧序号, 合并的帧数] 列表"""
+    kept = []
+    for i in range(0, len(frame_keys), skip):
+        if kept and frame_keys[i] is not None and frame_keys[i] == frame_keys[kept[-1][0]]:
+            kept[-1][1] += 1
+        else:
+            kept.append([i, 1])
+    return kept
+
+def select_frames_with_gifsicle(frame_keys, skip, delay):
+    """直接由gifsicle每隔skip帧选取一帧并优化，不经过Pillow解码和重新编码"""
+    command = [GIFSICLE, '-O3', '-U', _input_path]  # 先还原为完整帧，删除帧后画面才正确
+    if delay is None:
+        # 沿用原始延迟，无法累加被合并帧的延迟，不做去重
+        command.extend(f'#{i}' for i in range(0, len(frame_keys), skip))
     else:
-        # 至少保留一帧
-        with Image.open(input_gif) as img:
-            first_frame = next(ImageSequence.Iterator(img))
-            first_frame.save(output_pattern, duration=delay, loop=loop)
+        # 连续相同的帧只保留一帧，延迟累加到保留的帧上；帧选项作用于其后的帧选择
+        for i, count in merge_duplicate_frames(frame_keys, skip):
+            command.extend([f'--delay={delay * count // 10}', f'#{i}'])  # gifsicle的延迟单位是1/100秒
+    command.extend(['-o', '-'])
+    return subprocess.run(command, stdout=subprocess.PIPE, check=True, close_fds=False).stdout
+
+def select_frames_with_pillow(skip, delay):
+    """用Pillow抽帧后通过stdin交给gifsicle优化"""
+    frames_buffer = io.BytesIO()
+    extract_frames(frames_buffer, skip, delay)
+    
+    # 检查提取是否成功
+    if frames_buffer.tell() < 1024:
+        raise ValueError("帧提取失败")
+    
+    return subprocess.run([GIFSICLE, '-O3', '-', '-o', '-'],
+                          input=frames_buffer.getvalue(), stdout=subprocess.PIPE,
+                          check=True, close_fds=False).stdout
 
 def process_strategy(strategy_data):
-    """处理单个压缩策略"""
-    input_path, strategy, target_size_kb, process_id = strategy_data
+    """处理单个压缩策略的抽帧阶段，返回抽帧并优化后的中间结果"""
+    strategy, target_size_kb, process_id, frame_keys, use_pillow = strategy_data
+    original_frame_count = len(frame_keys)
     skip = strategy['skip']
     delay = strategy['delay']
     
     # 输出前缀，用于区分不同进程
     prefix = f"进程 {process_id}: "
     
+    if is_cancelled():
+        return {
+            'success': False,
+            'size': float('inf'),
+            'file': None
+        }
+    
     # 预计剩余帧数
-    original_frame_count = get_frame_count(input_path)
     expected_frames = math.ceil(original_frame_count / skip)
     print(f"{prefix}策略: 保留约 {expected_frames} 帧 (每 {skip} 帧取1帧), 帧延迟: {delay}ms")
     
-    # 提取帧
+    # 抽帧并优化，结果保留在内存中供lossy阶段复用
     try:
-        temp_file_frames = tempfile.NamedTemporaryFile(suffix='.gif', delete=False).name
-        extract_frames(input_path, temp_file_frames, skip, delay)
+        if use_pillow:
+            frames_data = select_frames_with_pillow(skip, delay)
+        else:
+            try:
+                frames_data = select_frames_with_gifsicle(frame_keys, skip, delay)
+            except subprocess.CalledProcessError as e:
+                # 由主进程解码一次输入GIF后再统一改用Pillow抽帧重试
+                print(f"{prefix}  gifsicle抽帧出错，稍后改用Pillow抽帧: {e}")
+                return {
+                    'success': False,
+                    'size': float('inf'),
+                    'file': None,
+                    'process_id': process_id,
+                    'retry_with_pillow': True
+                }
         
-        # 检查提取是否成功
-        if not os.path.exists(temp_file_frames) or get_file_size_kb(temp_file_frames) < 1:
-            print(f"{prefix}  帧提取失败")
-            return {
-                'success': False,
-                'size': float('inf'),
-                'file': None
-            }
+        frames_size = len(frames_data) / 1024
+        print(f"{prefix}  抽帧后大小: {frames_size:.2f} KB")
+        
+        if frames_size <= target_size_kb:
+            print(f"{prefix}  已达到目标大小!")
+        return {
+            'success': True,
+            'size': frames_size,
+            'data': frames_data,
+            'process_id': process_id,
+            'skip': skip
+        }
     except Exception as e:
         print(f"{prefix}  帧提取出错: {e}")
         return {
@@ -85,78 +352,130 @@ def process_strategy(strategy_data):
             'size': float('inf'),
             'file': None
         }
+
+def process_lossy(lossy_data):
+    """对抽帧阶段的结果应用单个lossy级别，输入输出都通过管道传递，候选结果不写入磁盘"""
+    frame_result, lossy_level, cancel_event = lossy_data
+    prefix = f"进程 {frame_result['process_id']}: "
     
-    # 优化提取后的帧
     try:
-        temp_file_frames_opt = tempfile.NamedTemporaryFile(suffix='.gif', delete=False).name
-        subprocess.run(['gifsicle', '-O3', temp_file_frames, '-o', temp_file_frames_opt], check=True)
-        os.unlink(temp_file_frames)  # 删除未优化的版本
-        temp_file_frames = temp_file_frames_opt
-        
-        frames_size = get_file_size_kb(temp_file_frames)
-        print(f"{prefix}  抽帧后大小: {frames_size:.2f} KB")
-        
-        if frames_size <= target_size_kb:
-            print(f"{prefix}  已达到目标大小!")
+        if cancel_event.is_set():
             return {
-                'success': True,
-                'size': frames_size,
-                'file': temp_file_frames
+                'success': False,
+                'size': float('inf'),
+                'file': None
             }
+        # 每个lossy级别单独启动一次gifsicle：--batch只会用同一组选项原地改写输入文件，
+        # 无法在一个进程中按不同lossy级别输出多个结果；输入已在内存中，启动开销很小
+        final_data = subprocess.run([GIFSICLE, '-O3', '--lossy=' + str(lossy_level), '-', '-o', '-'],
+                                    input=frame_result['data'], stdout=subprocess.PIPE,
+                                    check=True, close_fds=False).stdout
+        
+        final_size = len(final_data) / 1024
+        print(f"{prefix}  抽帧 + lossy={lossy_level} 后大小: {final_size:.2f} KB")
+        return {
+            'success': True,
+            'size': final_size,
+            'data': final_data,
+            'skip': frame_result['skip'],
+            'lossy_level': lossy_level
+        }
     except Exception as e:
-        print(f"{prefix}  帧优化出错: {e}")
-        if os.path.exists(temp_file_frames):
-            os.unlink(temp_file_frames)
+        print(f"{prefix}  lossy={lossy_level}压缩出错: {e}")
         return {
             'success': False,
             'size': float('inf'),
             'file': None
         }
-    
-    # 尝试不同的lossy值
-    best_size = frames_size
-    best_file = temp_file_frames
-    
-    for lossy_level in [30, 60, 90, 120, 150, 180, 210, 240]:
-        try:
-            temp_final = tempfile.NamedTemporaryFile(suffix='.gif', delete=False).name
-            subprocess.run(['gifsicle', '-O3', '--lossy=' + str(lossy_level), 
-                        best_file, '-o', temp_final], check=True)
-            
-            final_size = get_file_size_kb(temp_final)
-            print(f"{prefix}  抽帧 + lossy={lossy_level} 后大小: {final_size:.2f} KB")
-            
-            if final_size <= target_size_kb:
-                print(f"{prefix}  已达到目标大小!")
-                if best_size > final_size:
-                    if os.path.exists(best_file) and best_file != temp_file_frames:
-                        os.unlink(best_file)
-                    best_size = final_size
-                    best_file = temp_final
-                else:
-                    os.unlink(temp_final)
-                break
-            
-            if final_size < best_size:
-                if os.path.exists(best_file) and best_file != temp_file_frames:
-                    os.unlink(best_file)
-                best_size = final_size
-                best_file = temp_final
-            else:
-                os.unlink(temp_final)
-        except Exception as e:
-            print(f"{prefix}  lossy={lossy_level}压缩出错: {e}")
-            if os.path.exists(temp_final):
-                os.unlink(temp_final)
-    
-    return {
-        'success': True,
-        'size': best_size,
-        'file': best_file
-    }
+
+def run_tasks(executor, func, tasks, target_size_kb, cancel_event, stop_at_target=True, failed=None):
+    """并行执行任务并返回所有成功的结果，stop_at_target为真时任一结果达到目标大小即通知其余任务停止
+    
+    传入failed列表时，失败的结果会追加到其中
+    """
+    futures = [executor.submit(func, task) for task in tasks]
+    results = []
+    for future in as_completed(futures):
+        if future.cancelled():
+            continue
+        result = future.result()
+        if not result['success']:
+            if failed is not None:
+                failed.append(result)
+            continue
+        # 取消时仍在运行的任务也会返回结果，一并收集作为候选
+        results.append(result)
+        
+        if stop_at_target and result['size'] <= target_size_kb and not cancel_event.is_set():
+            cancel_event.set()
+            for pending in futures:
+                pending.cancel()
+    return results
+
+def predict_lossy_level(base_size, max_lossy_size, target_size_kb):
+    """按 size(lossy) ≈ a + b·lossy 的线性模型预测达到目标大小的最小lossy级别，预测无法达到时返回None"""
+    slope = (max_lossy_size - base_size) / LOSSY_LEVELS[-1]
+    for lossy_level in LOSSY_LEVELS:
+        if base_size + slope * lossy_level <= target_size_kb:
+            return lossy_level
+    return None
+
+def update_lossy_bounds(bounds, results, target_size_kb):
+    """根据lossy结果收窄各策略的搜索区间：[已知未达标的最高级别下标, 已知达标的最低级别下标]"""
+    for result in results:
+        index = LOSSY_LEVELS.index(result['lossy_level'])
+        miss_index, fit_index = bounds[result['skip']]
+        if result['size'] <= target_size_kb:
+            bounds[result['skip']] = [miss_index, min(fit_index, index)]
+        else:
+            bounds[result['skip']] = [max(miss_index, index), fit_index]
+
+def next_lossy_level(miss_index, fit_index, predicted=None):
+    """返回策略下一个要尝试的lossy级别：预测值落在搜索区间内时优先使用，否则在区间内二分，区间内没有级别时返回None"""
+    upper = min(fit_index, len(LOSSY_LEVELS))
+    if predicted is not None and miss_index < LOSSY_LEVELS.index(predicted) < upper:
+        return predicted
+    next_index = (miss_index + fit_index) // 2
+    if miss_index < next_index < upper:
+        return LOSSY_LEVELS[next_index]
+    return None
+
+def plan_lossy_levels(frames_by_skip, max_lossy_sizes, target_size_kb):
+    """根据探测策略在最高lossy级别下的压缩比例，按skip线性插值出其余策略的比例，为每个策略预测lossy级别
+    
+    只有一个探测结果时所有策略都使用该比例，没有探测结果时不做预测
+    """
+    if not max_lossy_sizes:
+        return {}
+    
+    probed_skips = sorted(max_lossy_sizes)
+    low_skip, high_skip = probed_skips[0], probed_skips[-1]
+    low_ratio = max_lossy_sizes[low_skip] / frames_by_skip[low_skip]['size']
+    high_ratio = max_lossy_sizes[high_skip] / frames_by_skip[high_skip]['size']
+    
+    plan = {}
+    for skip, frame_result in frames_by_skip.items():
+        if skip in max_lossy_sizes:
+            max_lossy_size = max_lossy_sizes[skip]
+        else:
+            weight = (skip - low_skip) / (high_skip - low_skip) if high_skip != low_skip else 0
+            max_lossy_size = frame_result['size'] * (low_ratio + (high_ratio - low_ratio) * weight)
+        lossy_level = predict_lossy_level(frame_result['size'], max_lossy_size, target_size_kb)
+        if lossy_level is not None:
+            plan[skip] = lossy_level
+    return plan
+
+def save_result(result, output_path):
+    """将结果保存到输出路径，结果可能在内存中(data)或在临时文件中(file)"""
+    if 'data' in result:
+        remove_output(output_path)
+        with open(output_path, 'wb') as f:
+            f.write(result['data'])
+    else:
+        move_file(result['file'], output_path)
 
 def optimize_gif(input_path, output_path, target_size_kb, min_frame_percent=10, threads=0):
-    """压缩GIF到目标大小，保持颜色数量和尺寸 (并行版本)"""
+    """压缩GIF到目标大小，保持颜色数量和尺寸 (并行版本)，返回输出文件的大小（KB）"""
     # 设置线程数
     if threads <= 0:
         threads = multiprocessing.cpu_count()
@@ -167,106 +486,151 @@ def optimize_gif(input_path, output_path, target_size_kb, min_frame_percent=10,
     
     if original_size <= target_size_kb:
         print("文件已经小于目标大小，无需压缩")
-        shutil.copy(input_path, output_path)
-        return
-    
-    # 获取初始帧数
-    original_frame_count = get_frame_count(input_path)
-    print(f"原始帧数: {original_frame_count}")
-    
-    # 基础优化 - 使用gifsicle的最高优化级别
-    temp_file_opt = tempfile.NamedTemporaryFile(suffix='.gif', delete=False).name
-    subprocess.run(['gifsicle', '-O3', input_path, '-o', temp_file_opt], check=True)
-    
-    opt_size = get_file_size_kb(temp_file_opt)
-    print(f"基础优化后大小: {opt_size:.2f} KB")
-    
-    if opt_size <= target_size_kb:
-        shutil.move(temp_file_opt, output_path)
-        return
-    
-    # 计算最小保留帧数
-    min_frames = max(3, int(original_frame_count * min_frame_percent / 100))
-    
-    # 生成压缩策略
-    strategies = []
-    
-    # 从2抽1开始，最多抽到保留最小帧数
-    max_skip = max(2, min(10, math.ceil(original_frame_count / min_frames)))
-    for skip in range(2, max_skip + 1):
-        strategies.append({
-            'skip': skip,
-            'delay': int(100 * skip / original_frame_count) + 10  # 根据抽帧比例调整延迟
-        })
-    
-    # 如果帧数很多，尝试更激进的抽帧策略
-    if original_frame_count > 30:
-        aggressive_skips = [max_skip + 5, max_skip + 10]
-        for skip in aggressive_skips:
-            if original_frame_count / skip >= min_frames:
-                strategies.append({
-                    'skip': skip,
-                    'delay': int(100 * skip / original_frame_count) + 10
-                })
-    
-    # 限制线程数不超过策略数量
-    actual_threads = min(threads, len(strategies))
-    print(f"开始使用 {actual_threads} 个进程并行处理 {len(strategies)} 个压缩策略...")
-    
-    # 准备并行处理的数据
-    process_data = [
-        (input_path, strategy, target_size_kb, i+1) 
-        for i, strategy in enumerate(strategies)
-    ]
-    
-    # 创建进程池处理多个策略
-    best_size = opt_size
-    best_file = temp_file_opt
-    
-    with multiprocessing.Pool(processes=actual_threads) as pool:
-        # 异步执行所有策略
-        results = []
-        for result in pool.imap_unordered(process_strategy, process_data):
-            results.append(result)
-            
-            # 如果找到满足条件的结果，提前结束
-            if result['success'] and result['size'] <= target_size_kb:
-                pool.terminate()  # 立即终止所有进程
-                break
-    
-    # 分析结果，找出最佳结果
-    for result in results:
-        if not result['success']:
-            continue
-            
-        if result['size'] <= target_size_kb:
-            # 已达到目标大小
-            if best_file != temp_file_opt and os.path.exists(best_file):
-                os.unlink(best_file)
-            best_size = result['size']
-            best_file = result['file']
+        link_or_copy(input_path, output_path)
+        return original_size
+    
+    # 本次运行的所有中间文件都放在同一个临时目录中，结束时统一清理
+    with tempfile.TemporaryDirectory(dir=TEMP_ROOT) as temp_dir:
+        # 获取初始帧数
+        frame_keys = get_frame_keys(input_path)
+        original_frame_count = len(frame_keys)
+        print(f"原始帧数: {original_frame_count}")
+        
+        # 基础优化 - 使用gifsicle的最高优化级别
+        temp_file_opt = create_temp_gif(temp_dir)
+        subprocess.run([GIFSICLE, '-O3', input_path, '-o', temp_file_opt], check=True, close_fds=False)
+        
+        opt_size = get_file_size_kb(temp_file_opt)
+        print(f"基础优化后大小: {opt_size:.2f} KB")
+        
+        if opt_size <= target_size_kb:
+            move_file(temp_file_opt, output_path)
+            return opt_size
+        
+        # 计算最小保留帧数
+        min_frames = max(3, int(original_frame_count * min_frame_percent / 100))
+        
+        # 生成压缩策略
+        strategies = []
+        
+        # 从2抽1开始，最多抽到保留最小帧数
+        max_skip = max(2, min(10, math.ceil(original_frame_count / min_frames)))
+        for skip in range(2, max_skip + 1):
+            strategies.append({
+                'skip': skip,
+                'delay': int(100 * skip / original_frame_count) + 10  # 根据抽帧比例调整延迟
+            })
+        
+        # 如果帧数很多，尝试更激进的抽帧策略
+        if original_frame_count > 30:
+            aggressive_skips = [max_skip + 5, max_skip + 10]
+            for skip in aggressive_skips:
+                if original_frame_count / skip >= min_frames:
+                    strategies.append({
+                        'skip': skip,
+                        'delay': int(100 * skip / original_frame_count) + 10
+                    })
+        
+        print(f"开始并行处理 {len(strategies)} 个压缩策略...")
+        
+        # 准备并行处理的数据
+        process_data = [
+            (strategy, target_size_kb, i+1, frame_keys, False)
+            for i, strategy in enumerate(strategies)
+        ]
+        
+        cancel_event = multiprocessing.Event()
+        
+        # 第一阶段：并行抽帧，每个策略生成一个优化后的中间结果
+        failed = []
+        with ProcessPoolExecutor(max_workers=min(threads, len(strategies)),
+                                 initializer=init_worker,
+                                 initargs=(cancel_event, input_path)) as executor:
+            frame_results = run_tasks(executor, process_strategy, process_data,
+                                      target_size_kb, cancel_event, failed=failed)
+        
+        # gifsicle抽帧失败的策略改用Pillow重试：默认以fork启动工作进程的平台（Linux）上主进程只解码一次输入GIF，
+        # 工作进程直接继承已解码的帧；macOS和Windows默认使用spawn（macOS上fork出的子进程可能崩溃），仍由各工作进程自行解码
+        retry_data = [
+            (strategies[result['process_id'] - 1], target_size_kb, result['process_id'], frame_keys, True)
+            for result in failed if result.get('retry_with_pillow')
+        ]
+        if retry_data and not cancel_event.is_set() and multiprocessing.get_start_method() == 'fork':
+            try:
+                preload_frames(input_path)
+            except Exception as e:
+                print(f"Pillow解码输入GIF出错，跳过Pillow抽帧: {e}")
+                retry_data = []
+        if retry_data and not cancel_event.is_set():
+            try:
+                with ProcessPoolExecutor(max_workers=min(threads, len(retry_data)),
+                                         initializer=init_worker,
+                                         initargs=(cancel_event, input_path)) as executor:
+                    frame_results += run_tasks(executor, process_strategy, retry_data,
+                                               target_size_kb, cancel_event)
+            finally:
+                release_frames()
+        results = list(frame_results)
+        
+        # 第二阶段：文件大小随skip和lossy单调递减，先探测再按模型预测的lossy级别压缩
+        # 这一阶段只是等待gifsicle子进程，使用线程池即可并行，各线程直接共享内存中的抽帧数据
+        if not cancel_event.is_set() and frame_results:
+            frames_by_skip = {result['skip']: result for result in frame_results}
+            skips = sorted(frames_by_skip)
+            max_level = LOSSY_LEVELS[-1]
+            # 线程与主进程共享模块全局变量，取消事件随任务传入，不能复用进程池的初始化函数
+            with ThreadPoolExecutor(max_workers=min(threads, len(frame_results))) as executor:
+                # 探测最小和最大skip策略在最高lossy级别下的大小，用于拟合模型
+                probe_data = [(frames_by_skip[skip], max_level, cancel_event) for skip in sorted({skips[0], skips[-1]})]
+                probe_results = run_tasks(executor, process_lossy, probe_data,
+                                          target_size_kb, cancel_event, stop_at_target=False)
+                results.extend(probe_results)
+                max_lossy_sizes = {result['skip']: result['size'] for result in probe_results}
+                bounds = {skip: [-1, len(LOSSY_LEVELS)] for skip in frames_by_skip}
+                update_lossy_bounds(bounds, probe_results, target_size_kb)
+                
+                plan = plan_lossy_levels(frames_by_skip, max_lossy_sizes, target_size_kb)
+                next_levels = {skip: next_lossy_level(*bounds[skip], lossy_level)
+                               for skip, lossy_level in plan.items()}
+                
+                # 逐轮提交组合：lossy的大小曲线是凸的，线性模型的预测往往偏高，
+                # 因此达标后继续向更低的级别二分，未达标则向更高的级别二分，找出每个策略达标的最低lossy级别
+                while True:
+                    lossy_data = [
+                        (frames_by_skip[skip], lossy_level, cancel_event)
+                        for skip, lossy_level in sorted(next_levels.items())
+                        if lossy_level is not None
+                    ]
+                    if not lossy_data:
+                        break
+                    print(f"根据模型尝试 {len(lossy_data)} 个 (策略, lossy) 组合...")
+                    round_results = run_tasks(executor, process_lossy, lossy_data,
+                                              target_size_kb, cancel_event, stop_at_target=False)
+                    results.extend(round_results)
+                    update_lossy_bounds(bounds, round_results, target_size_kb)
+                    next_levels = {result['skip']: next_lossy_level(*bounds[result['skip']])
+                                   for result in round_results}
+        
+        # 分析结果，找出最佳结果
+        best_result = {'size': opt_size, 'file': temp_file_opt}
+        for result in results:
+            if is_closer_to_target(result['size'], best_result['size'], target_size_kb):
+                best_result = result
+        best_size = best_result['size']
+        if best_size <= target_size_kb:
             print(f"找到达到目标大小的策略! 大小: {best_size:.2f} KB")
-            break
-        elif result['size'] < best_size:
-            # 大小比之前的结果更好
-            if best_file != temp_file_opt and os.path.exists(best_file):
-                os.unlink(best_file)  # 删除之前的最佳文件
-            best_size = result['size']
-            best_file = result['file']
-    
-    # 使用找到的最佳文件
-    print("\n复制最佳结果到输出文件...")
-    shutil.move(best_file, output_path)
-    
-    # 清理临时文件
-    if os.path.exists(temp_file_opt) and temp_file_opt != best_file:
-        os.unlink(temp_file_opt)
-    
-    # 如果还是没达到目标大小，给出提示
-    if best_size > target_size_kb:
-        print(f"\n无法达到目标大小 {target_size_kb} KB。")
-        print(f"最接近的大小是 {best_size:.2f} KB，已保存到输出文件。")
-        print("建议尝试允许减少尺寸或颜色数量以达到更小的文件大小。")
+        
+        # 使用找到的最佳文件
+        print("\n复制最佳结果到输出文件...")
+        save_result(best_result, output_path)
+        
+        # 如果还是没达到目标大小，给出提示
+        if best_size > target_size_kb:
+            print(f"\n无法达到目标大小 {target_size_kb} KB。")
+            print(f"最接近的大小是 {best_size:.2f} KB，已保存到输出文件。")
+            print("建议尝试允许减少尺寸或颜色数量以达到更小的文件大小。")
+        
+        return best_size
 
 def main():
     # 记录开始时间
@@ -295,9 +659,7 @@ def main():
     
     thread_count = args.threads if args.threads > 0 else multiprocessing.cpu_count()
     print(f"开始压缩 '{args.input}' 到 '{args.output}' (目标: {args.target} KB, 线程数: {thread_count})")
-    optimize_gif(args.input, args.output, args.target, args.min_frames, args.threads)
-    
-    final_size = get_file_size_kb(args.output)
+    final_size = optimize_gif(args.input, args.output, args.target, args.min_frames, args.threads)
     print(f"完成! 最终大小: {final_size:.2f} KB")
     
     # 计算并输出处理时间